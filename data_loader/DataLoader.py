@@ -281,10 +281,12 @@ if __name__ == "__main__":
 
 class WV3(Dataset):
     def __init__(self, dir, transforms=None) -> None:
-        f = h5py.File(str(dir), 'r+')
-        self.hr = torch.tensor(f['gt'][()], dtype=torch.float32)
-        self.mslr = torch.tensor(f['ms'][()], dtype=torch.float32)
-        self.pan = torch.tensor(f['pan'][()], dtype=torch.float32)
+        # the h5 file is opened lazily in __getitem__ so every DataLoader
+        # worker owns its own handle instead of sharing a forked one
+        self.dir = dir
+        self.h5 = None
+        with h5py.File(str(dir), 'r') as f:
+            self.length = f['ms'].shape[0]
         self.transforms = transforms
 
         # precomputed
@@ -299,13 +301,15 @@ class WV3(Dataset):
              163.7575]).view(1, 8, 1, 1)
 
     def __len__(self):
-        return self.mslr.shape[0]
+        return self.length
 
     def __getitem__(self, index):
+        if self.h5 is None:
+            self.h5 = h5py.File(str(self.dir), 'r')
 
-        pan = self.pan[index]
-        mslr = self.mslr[index]
-        hr = self.hr[index]
+        pan = torch.tensor(self.h5['pan'][index], dtype=torch.float32)
+        mslr = torch.tensor(self.h5['ms'][index], dtype=torch.float32)
+        hr = torch.tensor(self.h5['gt'][index], dtype=torch.float32)
 
         if self.transforms:
             for transform, prob in self.transforms:
@@ -360,4 +364,52 @@ class WV3(Dataset):
     mean = channel_sum / total_samples
     std = torch.sqrt((channel_sum_of_squares / total_samples) - mean ** 2)
 
-    print('mean: ', mean, ' std: ', std)"""
\ No newline at end of file
+    print('mean: ', mean, ' std: ', std)"""
+
+
+class PreloadedH5:
+    def __init__(self, dir, batch_size, device, memory_format=torch.contiguous_format, storage_dtype=torch.float32, seed=0) -> None:
+        # the whole h5 file is read once and kept on the device, batches are
+        # sampled by indexing so there is no per step disk io or collate.
+        # storage_dtype=torch.float16 halves the cache, it is only kept for
+        # arrays it represents exactly, the others fall back to fp32
+        with h5py.File(str(dir), 'r') as f:
+            self.hr = self.load(f['gt'], storage_dtype, device, memory_format)
+            self.mslr = self.load(f['ms'], storage_dtype, device, memory_format)
+            self.pan = self.load(f['pan'], storage_dtype, device, memory_format)
+        self.batch_size = batch_size
+        self.device = device
+        self.memory_format = memory_format
+        self.length = self.mslr.shape[0]
+
+        # own generator, under ddp every rank must pass a different seed
+        # so the ranks draw different batches
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+
+    @staticmethod
+    def load(dataset, storage_dtype, device, memory_format):
+        x = torch.tensor(dataset[()], dtype=torch.float32)
+        if storage_dtype != torch.float32:
+            stored = x.to(storage_dtype)
+            if torch.equal(stored.to(torch.float32), x):
+                x = stored
+            else:
+                print(f'{dataset.name} is not exactly representable in {storage_dtype}, keeping fp32')
+        return x.to(device, memory_format=memory_format)
+
+    def __len__(self):
+        return self.length // self.batch_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        idx = torch.randint(0, self.length, (self.batch_size,),
+                            device=self.device, generator=self.generator)
+
+        pan = self.pan[idx].to(torch.float32, memory_format=self.memory_format)
+        mslr = self.mslr[idx].to(torch.float32, memory_format=self.memory_format)
+        hr = self.hr[idx].to(torch.float32, memory_format=self.memory_format)
+
+        return (pan, mslr, hr)
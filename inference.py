@@ -115,8 +115,8 @@ def main():
         dataset=test_dataset, batch_size=1, shuffle=False)
 
     # Initialize Model, optimizer, criterion and metrics
-    model = MDCUN(ms_channels=ms_channel, T=1, mslr_mean=train_dataset.mslr_mean.to(device), mslr_std=train_dataset.mslr_std.to(device), pan_mean=train_dataset.pan_mean.to(device),
-                  pan_std=train_dataset.pan_std.to(device)).to(device)
+    model = MDCUN(ms_channels=ms_channel, T=1, mslr_mean=train_dataset.mslr_mean, mslr_std=train_dataset.mslr_std, pan_mean=train_dataset.pan_mean,
+                  pan_std=train_dataset.pan_std).to(device)
 
     optimizer = Adam(model.parameters(), lr=5e-4)
 
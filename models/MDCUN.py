@@ -330,10 +330,13 @@ class MDCUN(nn.Module):
     def __init__(self, ms_channels,  mid_channels=64, T=4, **kwargs):
         super().__init__()
 
-        self.mslr_mean = kwargs.get('mslr_mean')
-        self.mslr_std = kwargs.get('mslr_std')
-        self.pan_mean = kwargs.get('pan_mean')
-        self.pan_std = kwargs.get('pan_std')
+        # normalization statistics are buffers so they follow the model's
+        # device, they are not saved in the state dict
+        for name in ['mslr_mean', 'mslr_std', 'pan_mean', 'pan_std']:
+            value = kwargs.get(name)
+            if value is not None:
+                value = value.view(1, -1, 1, 1)
+            self.register_buffer(name, value, persistent=False)
 
         print("now: pan_unfolding_V4")
         self.up_factor = 4
@@ -1,49 +1,145 @@
+import os
+import copy
+import warnings
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
 
 import torch
+import torch.distributed as dist
 from torch.optim import Adam
 from torch.nn import L1Loss
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torchvision.transforms import Resize, RandomHorizontalFlip, RandomVerticalFlip, RandomRotation
 from torchmetrics import MetricCollection, PeakSignalNoiseRatio, StructuralSimilarityIndexMeasure
 from torch.optim.lr_scheduler import StepLR
 from torchinfo import summary
 
-from data_loader.DataLoader import DIV2K, GaoFen2, Sev2Mod, WV3, GaoFen2panformer
+from data_loader.DataLoader import DIV2K, GaoFen2, Sev2Mod, WV3, GaoFen2panformer, PreloadedH5
 from models.MDCUN import MDCUN
 from utils import *
 
 
-def main():
-    # Prepare device
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(device)
+def evaluate(model, prefetcher, criterion, metric_collection, n_steps, desc, device, use_amp, stream=None, report_interval=50):
+    """
+    Runs n_steps batches of the prefetcher through the model, restarting it if
+    exhausted, and returns the averaged loss, psnr and ssim.
+    """
+    stream_context = torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()
+    report_loss = 0
+    n_batches = 0
+    with stream_context, torch.inference_mode():
+        progress_bar = tqdm(iter(range(n_steps)), total=n_steps, desc=desc, mininterval=1.0,
+                            leave=False, bar_format='{desc:<8}{percentage:3.0f}%|{bar:15}{r_bar}')
+        data_iter = iter(prefetcher)
+        for step in progress_bar:
+            try:
+                # Samples the batch
+                pan, mslr, mshr = next(data_iter)
+            except StopIteration:
+                # restart the loader if the previous loader is exhausted.
+                data_iter = iter(prefetcher)
+                pan, mslr, mshr = next(data_iter)
+            # forward
+            with torch.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                mssr = model(pan, mslr)
+                loss = criterion(mssr, mshr)
+            metric = metric_collection.forward(mssr.float(), mshr)
+            report_loss += loss
+            n_batches += 1
+
+            # report metrics
+            if step % report_interval == 0:
+                progress_bar.set_postfix(
+                    loss=f'{loss.item()}', psnr=f'{metric["psnr"].item():.2f}', ssim=f'{metric["ssim"].item():.2f}')
+
+        # compute metrics total
+        report_loss = report_loss / n_batches
+        metric = metric_collection.compute()
+        metrics = {'loss': report_loss.item(),
+                   'psnr': metric['psnr'].item(),
+                   'ssim': metric['ssim'].item()}
+
+        # reset metrics
+        metric_collection.reset()
+
+    return metrics
+
 
-    # Initialize DataLoader
-    train_dataset = WV3(
-        Path("/home/ubuntu/project/Data/WorldView3/train/train_wv3-001.h5"))  # transforms=[(RandomHorizontalFlip(1), 0.3), (RandomVerticalFlip(1), 0.3)]
-    train_loader = DataLoader(
-        dataset=train_dataset, batch_size=4, shuffle=True, drop_last=True)
+def main():
+    # Prepare device, one process per gpu when launched with torchrun
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        dist.init_process_group(backend='nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        device = torch.device(f'cuda:{local_rank}')
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    is_main = not distributed or dist.get_rank() == 0
+    if is_main:
+        print(device)
+
+    # shapes are static, let cudnn pick the fastest (channels last) kernels once
+    torch.backends.cudnn.benchmark = True
+
+    # Initialize DataLoader, the training set is preloaded on the device
+    seed = 0
+    train_dir = Path("/home/ubuntu/project/Data/WorldView3/train/train_wv3-001.h5")
+    # only provides the normalization statistics, training batches come from
+    # PreloadedH5, use the augment flag below for training augmentation
+    train_dataset = WV3(train_dir)
+    train_loader = PreloadedH5(
+        train_dir, batch_size=4, device=device, memory_format=torch.channels_last, storage_dtype=torch.float16,
+        seed=seed + (dist.get_rank() if distributed else 0))
 
     validation_dataset = WV3(
         Path("/home/ubuntu/project/Data/WorldView3/val/valid_wv3.h5"))
     validation_loader = DataLoader(
-        dataset=validation_dataset, batch_size=1, shuffle=True)
+        dataset=validation_dataset, batch_size=1, shuffle=True, pin_memory=True,
+        num_workers=4, prefetch_factor=4, persistent_workers=True)
 
     test_dataset = WV3(
         Path("/home/ubuntu/project/Data/WorldView3/drive-download-20230627T115841Z-001/test_wv3_multiExm1.h5"))
     test_loader = DataLoader(
-        dataset=test_dataset, batch_size=1, shuffle=False)
+        dataset=test_dataset, batch_size=1, shuffle=False, pin_memory=True,
+        num_workers=4, prefetch_factor=4, persistent_workers=True)
 
     # Initialize Model, optimizer, criterion and metrics
-    model = MDCUN(ms_channels= 8, T=1, mslr_mean=train_dataset.mslr_mean.to(device), mslr_std=train_dataset.mslr_std.to(device), pan_mean=train_dataset.pan_mean.to(device),
-                  pan_std=train_dataset.pan_std.to(device)).to(device)
+    model = MDCUN(ms_channels= 8, T=1, mslr_mean=train_dataset.mslr_mean, mslr_std=train_dataset.mslr_std, pan_mean=train_dataset.pan_mean,
+                  pan_std=train_dataset.pan_std).to(device)
+    model = model.to(memory_format=torch.channels_last)
+
+    # Model summary
+    if is_main:
+        summary(model, [(1, 1, 256, 256), (1, 8, 64, 64)],
+                dtypes=[torch.float32, torch.float32])
 
-    optimizer = Adam(model.parameters(), lr=5e-4)
+    model_without_ddp = model
+    if distributed:
+        # the only buffers are the constant normalization statistics, no need
+        # to broadcast them from rank 0 on every forward
+        model = DDP(model, device_ids=[local_rank], bucket_cap_mb=50,
+                    broadcast_buffers=False)
+
+    # compile the training model, input shapes are fixed so specialize on them.
+    # max-autotune also captures the compiled forward and backward in cuda graphs
+    model = torch.compile(model, mode='max-autotune',
+                          fullgraph=False, dynamic=False)
+
+    optimizer = Adam(model.parameters(), lr=5e-4,
+                     fused=torch.cuda.is_available())
 
     criterion = L1Loss().to(device)
 
+    # mixed precision, fp16 autocast with a loss scaler on cuda
+    use_amp = device.type == 'cuda'
+    scaler = torch.amp.GradScaler(device.type, enabled=use_amp)
+
+    # metrics stay in fp32, the images are in raw sensor units (up to 2047) so
+    # squared errors and ssim variances overflow or cancel out in fp16
     metric_collection = MetricCollection({
         'psnr': PeakSignalNoiseRatio().to(device),
         'ssim': StructuralSimilarityIndexMeasure().to(device)
@@ -59,9 +155,7 @@ def main():
         'ssim': StructuralSimilarityIndexMeasure().to(device)
     })
 
-    tr_report_loss = 0
-    val_report_loss = 0
-    test_report_loss = 0
+    tr_report_loss = torch.zeros((), device=device)
     tr_metrics = []
     val_metrics = []
     test_metrics = []
@@ -71,194 +165,187 @@ def main():
     steps = 600000
     save_interval = 1000
     report_interval = 50
+    accum_steps = 1  # micro-steps accumulated per optimizer step
+    augment = False  # on-device random flips/rot90 of the training batches
     test_intervals = [100000, 200000, 300000,
                       400000,500000, 600000]
     evaluation_interval = [100000, 200000, 300000,
                       400000,500000, 600000]
 
     val_steps = 100
+    val_steps = val_steps if val_steps else len(validation_loader)
+    test_total = len(test_loader)
 
-    # Model summary
-    summary(model, [(1, 1, 256, 256), (1, 8, 64, 64)],
-            dtypes=[torch.float32, torch.float32])
-
-    scheduler = StepLR(optimizer, step_size=1, gamma=0.5)
+    # halve the lr every lr_decay_intervals training steps
     lr_decay_intervals = 150000
-
-    print('==> Starting training ...')
+    scheduler = StepLR(
+        optimizer, step_size=lr_decay_intervals // accum_steps, gamma=0.5)
+    # GradScaler skips the first optimizer steps while it finds its scale, these
+    # still count towards step_size, which shifts the decay by a few steps only
+    warnings.filterwarnings(
+        'ignore', message=r'Detected call of `lr_scheduler\.step\(\)` before `optimizer\.step\(\)`')
+
+    # copy batches to the device on a side stream
+    validation_prefetcher = CUDAPrefetcher(
+        validation_loader, device, memory_format=torch.channels_last)
+    test_prefetcher = CUDAPrefetcher(
+        test_loader, device, memory_format=torch.channels_last)
+
+    # validation and test run in a worker thread on their own stream
+    eval_stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+    evaluator = ThreadPoolExecutor(max_workers=1)
+    pending_evals = []
+
+    # checkpoints are snapshotted on the main thread and written in the background
+    saver = ThreadPoolExecutor(max_workers=1)
+    pending_save = None
+
+    if is_main:
+        print('==> Starting training ...')
     train_iter = iter(train_loader)
-    train_progress_bar = tqdm(iter(range(steps)), total=steps, desc="Training",
-                              leave=False, bar_format='{desc:<8}{percentage:3.0f}%|{bar:15}{r_bar}')
+    train_progress_bar = tqdm(iter(range(steps)), total=steps, desc="Training", mininterval=1.0,
+                              leave=False, bar_format='{desc:<8}{percentage:3.0f}%|{bar:15}{r_bar}', disable=not is_main)
     for step in train_progress_bar:
-        if step % save_interval == 0 and step != 0:
+        if step % save_interval == 0 and step != 0 and is_main:
             checkpoint = {'step': step,
-                          'state_dict': model.state_dict(),
+                          'state_dict': model_without_ddp.state_dict(),
                           'optimizer': optimizer.state_dict(),
                           'tr_metrics': tr_metrics,
                           'val_metrics': val_metrics,
                           'test_metrics': test_metrics}
-            save_checkpoint(checkpoint, 'MDCUN', current_daytime)
-
-        try:
-            # Samples the batch
-            pan, mslr, mshr = next(train_iter)
-        except StopIteration:
-            # restart the loader if the previous loader is exhausted.
-            train_iter = iter(train_loader)
-            pan, mslr, mshr = next(train_iter)
-
-        # forward
-        pan, mslr, mshr = pan.to(device), mslr.to(device), mshr.to(device)
-        mssr = model(pan, mslr)
-        tr_loss = criterion(mssr, mshr)
-        tr_report_loss += tr_loss
-        batch_metric = metric_collection.forward(mssr, mshr)
-
-        # backward
-        optimizer.zero_grad()
-        tr_loss.backward()
-        optimizer.step()
-
-        batch_metrics = {'loss': tr_loss.item(),
-                         'psnr': batch_metric['psnr'].item(),
-                         'ssim': batch_metric['ssim'].item()}
-
-        # report metrics
-        train_progress_bar.set_postfix(
-            loss=batch_metrics["loss"], psnr=f'{batch_metrics["psnr"]:.4f}', ssim=f'{batch_metrics["ssim"]:.4f}')
-
-        # lr_decay
-        if step % lr_decay_intervals == 0 and step != 0:
+            if pending_save is not None:
+                # re-raise a failed previous save instead of training on without checkpoints
+                pending_save.result()
+            pending_save = saver.submit(save_checkpoint, snapshot_state(
+                checkpoint), 'MDCUN', current_daytime)
+
+        # Samples the batch
+        pan, mslr, mshr = next(train_iter)
+        if augment:
+            pan, mslr, mshr = random_flip_rot90(
+                (pan, mslr, mshr), prob=0.3, memory_format=torch.channels_last)
+
+        # forward and backward, ddp only all-reduces on the last micro-step
+        sync_step = (step + 1) % accum_steps == 0
+        sync_context = model.no_sync() if distributed and not sync_step else contextlib.nullcontext()
+        # each step replays the captured graphs, outputs of the previous step are not reused
+        torch.compiler.cudagraph_mark_step_begin()
+        with sync_context:
+            with torch.autocast(device.type, dtype=torch.float16, enabled=use_amp):
+                mssr = model(pan, mslr)
+                tr_loss = criterion(mssr, mshr)
+            scaler.scale(tr_loss / accum_steps).backward()
+        tr_report_loss += tr_loss.detach()
+
+        # psnr/ssim are only sampled on the report step of each interval
+        report_step = (step + 1) % report_interval == 0 and step != 0
+        if report_step:
+            metric_collection.update(mssr.float(), mshr)
+
+        # optimizer step
+        if sync_step:
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
+
+            # lr_decay
             scheduler.step()
             # print(scheduler.get_last_lr())
 
         # Store metrics
-        if (step + 1) % report_interval == 0 and step != 0:
+        if report_step:
             # Batch metrics
             tr_report_loss = tr_report_loss / (report_interval)
             tr_metric = metric_collection.compute()
 
-            # store metrics
+            # store metrics, the only host sync of the training loop
             tr_metrics.append({'loss': tr_report_loss.item(),
                                'psnr': tr_metric['psnr'].item(),
                                'ssim': tr_metric['ssim'].item()})
 
+            # report metrics
+            train_progress_bar.set_postfix(
+                loss=tr_metrics[-1]["loss"], psnr=f'{tr_metrics[-1]["psnr"]:.4f}', ssim=f'{tr_metrics[-1]["ssim"]:.4f}')
+
             # reset metrics
-            tr_report_loss = 0
+            tr_report_loss = torch.zeros((), device=device)
             metric_collection.reset()
 
-        # Evaluate model
-        if (step + 1) in evaluation_interval and step != 0:
-            # evaluation mode
-            model.eval()
-            with torch.no_grad():
+        # Evaluate and test a frozen copy of the model in the background
+        run_val = (step + 1) in evaluation_interval and step != 0 and is_main
+        run_test = (step + 1) in test_intervals and step != 0 and is_main
+        if run_val or run_test:
+            eval_model = copy.deepcopy(model_without_ddp).eval()
+            eval_optimizer_state = copy.deepcopy(optimizer.state_dict())
+            if eval_stream is not None:
+                # the snapshot copies must finish before the eval stream reads them
+                eval_stream.wait_stream(torch.cuda.current_stream())
+            if run_val:
                 print("\n==> Start evaluating ...")
-                val_steps = val_steps if val_steps else len(validation_loader)
-                eval_progress_bar = tqdm(iter(range(val_steps)), total=val_steps, desc="Validation",
-                                         leave=False, bar_format='{desc:<8}{percentage:3.0f}%|{bar:15}{r_bar}')
-                val_iter = iter(validation_loader)
-                for eval_step in eval_progress_bar:
-                    try:
-                        # Samples the batch
-                        pan, mslr, mshr = next(val_iter)
-                    except StopIteration:
-                        # restart the loader if the previous loader is exhausted.
-                        val_iter = iter(validation_loader)
-                        pan, mslr, mshr = next(val_iter)
-                    # forward
-                    pan, mslr, mshr = pan.to(device), mslr.to(
-                        device), mshr.to(device)
-                    mssr = model(pan, mslr)
-                    val_loss = criterion(mssr, mshr)
-                    val_metric = val_metric_collection.forward(mssr, mshr)
-                    val_report_loss += val_loss
-
-                    # report metrics
-                    eval_progress_bar.set_postfix(
-                        loss=f'{val_loss.item()}', psnr=f'{val_metric["psnr"].item():.2f}', ssim=f'{val_metric["ssim"].item():.2f}')
-
-                # compute metrics total
-                val_report_loss = val_report_loss / len(validation_loader)
-                val_metric = val_metric_collection.compute()
-                val_metrics.append({'loss': val_report_loss.item(),
-                                    'psnr': val_metric['psnr'].item(),
-                                    'ssim': val_metric['ssim'].item()})
-
+                pending_evals.append({'name': 'val', 'step': step, 'model': eval_model,
+                                      'optimizer': eval_optimizer_state,
+                                      'future': evaluator.submit(evaluate, eval_model, validation_prefetcher, criterion,
+                                                                 val_metric_collection, val_steps, "Validation", device, use_amp, eval_stream, report_interval)})
+            if run_test:
+                print("\n==> Start testing ...")
+                pending_evals.append({'name': 'test', 'step': step, 'model': eval_model,
+                                      'optimizer': eval_optimizer_state,
+                                      'future': evaluator.submit(evaluate, eval_model, test_prefetcher, criterion,
+                                                                 test_metric_collection, test_total, "Testing", device, use_amp, eval_stream, report_interval)})
+
+        # collect finished evaluations, wait for the remaining ones after the last step
+        while pending_evals and (pending_evals[0]['future'].done() or step == steps - 1):
+            pending = pending_evals.pop(0)
+            metrics = pending['future'].result()
+
+            if pending['name'] == 'val':
+                val_metrics.append(metrics)
                 print(
-                    f'\nEvaluation: avg_loss = {val_report_loss.item():.4f} , avg_psnr= {val_metric["psnr"]:.4f}, avg_ssim={val_metric["ssim"]:.4f}')
-
-                # reset metrics
-                val_report_loss = 0
-                val_metric_collection.reset()
+                    f'\nEvaluation: avg_loss = {metrics["loss"]:.4f} , avg_psnr= {metrics["psnr"]:.4f}, avg_ssim={metrics["ssim"]:.4f}')
                 print("==> End evaluating <==\n")
 
-            # train mode
-            model.train()
-
-            # save best evaluation model based on PSNR
-            if val_metrics[-1]['psnr'] > best_eval_psnr:
-                best_eval_psnr = val_metrics[-1]['psnr']
-                checkpoint = {'step': step,
-                              'state_dict': model.state_dict(),
-                              'optimizer': optimizer.state_dict(),
-                              'tr_metrics': tr_metrics,
-                              'val_metrics': val_metrics,
-                              'test_metrics': test_metrics}
-                save_checkpoint(checkpoint, 'MDCUN',
-                                current_daytime + '_best_eval')
-
-        # test model
-        if (step + 1) in test_intervals and step != 0:
-            # evaluation mode
-            model.eval()
-            with torch.no_grad():
-                print("\n==> Start testing ...")
-                test_progress_bar = tqdm(iter(test_loader), total=len(
-                    test_loader), desc="Testing", leave=False, bar_format='{desc:<8}{percentage:3.0f}%|{bar:15}{r_bar}')
-                for pan, mslr, mshr in test_progress_bar:
-                    # forward
-                    pan, mslr, mshr = pan.to(device), mslr.to(
-                        device), mshr.to(device)
-                    mssr = model(pan, mslr)
-                    test_loss = criterion(mssr, mshr)
-                    test_metric = test_metric_collection.forward(mssr, mshr)
-                    test_report_loss += test_loss
-
-                    # report metrics
-                    test_progress_bar.set_postfix(
-                        loss=f'{test_loss.item()}', psnr=f'{test_metric["psnr"].item():.2f}', ssim=f'{test_metric["ssim"].item():.2f}')
-
-                # compute metrics total
-                test_report_loss = test_report_loss / len(test_loader)
-                test_metric = test_metric_collection.compute()
-                test_metrics.append({'loss': test_report_loss.item(),
-                                     'psnr': test_metric['psnr'].item(),
-                                     'ssim': test_metric['ssim'].item()})
-
+                # save best evaluation model based on PSNR
+                if metrics['psnr'] > best_eval_psnr:
+                    best_eval_psnr = metrics['psnr']
+                    checkpoint = {'step': pending['step'],
+                                  'state_dict': pending['model'].state_dict(),
+                                  'optimizer': pending['optimizer'],
+                                  'tr_metrics': tr_metrics,
+                                  'val_metrics': val_metrics,
+                                  'test_metrics': test_metrics}
+                    if pending_save is not None:
+                        pending_save.result()
+                    pending_save = saver.submit(save_checkpoint, snapshot_state(checkpoint), 'MDCUN',
+                                                current_daytime + '_best_eval')
+            else:
+                test_metrics.append(metrics)
                 print(
-                    f'\nTesting: avg_loss = {test_report_loss.item():.4f} , avg_psnr= {test_metric["psnr"]:.4f}, avg_ssim={test_metric["ssim"]:.4f}')
-
-                # reset metrics
-                test_report_loss = 0
-                test_metric_collection.reset()
+                    f'\nTesting: avg_loss = {metrics["loss"]:.4f} , avg_psnr= {metrics["psnr"]:.4f}, avg_ssim={metrics["ssim"]:.4f}')
                 print("==> End testing <==\n")
 
-            # train mode
-            model.train()
-
-            # save best test model based on PSNR
-            if test_metrics[-1]['psnr'] > best_test_psnr:
-                best_test_psnr = test_metrics[-1]['psnr']
-                checkpoint = {'step': step,
-                              'state_dict': model.state_dict(),
-                              'optimizer': optimizer.state_dict(),
-                              'tr_metrics': tr_metrics,
-                              # 'val_metrics': val_metrics,
-                              'test_metrics': test_metrics}
-                save_checkpoint(checkpoint, 'MDCUN',
-                                current_daytime + '_best_test')
-
-    print('==> training ended <==')
+                # save best test model based on PSNR
+                if metrics['psnr'] > best_test_psnr:
+                    best_test_psnr = metrics['psnr']
+                    checkpoint = {'step': pending['step'],
+                                  'state_dict': pending['model'].state_dict(),
+                                  'optimizer': pending['optimizer'],
+                                  'tr_metrics': tr_metrics,
+                                  # 'val_metrics': val_metrics,
+                                  'test_metrics': test_metrics}
+                    if pending_save is not None:
+                        pending_save.result()
+                    pending_save = saver.submit(save_checkpoint, snapshot_state(checkpoint), 'MDCUN',
+                                                current_daytime + '_best_test')
+
+    evaluator.shutdown()
+    if pending_save is not None:
+        pending_save.result()
+    saver.shutdown()
+    if is_main:
+        print('==> training ended <==')
+
+    if distributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':
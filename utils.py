@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 import torch
 import datetime
@@ -45,8 +46,100 @@ def save_checkpoint(state, filename: str, current_daytime: str):
     checkpoint_path = get_checkpoint_path()
 
     (checkpoint_path/filename).mkdir(parents=True, exist_ok=True)
-    torch.save(state,  checkpoint_path / filename /
-               f'{filename}_{current_daytime}.pth.tar')
+    path = checkpoint_path / filename / f'{filename}_{current_daytime}.pth.tar'
+    # write next to the target and rename, so a checkpoint is never half written
+    tmp_path = path.with_name(path.name + '.tmp')
+    try:
+        torch.save(state, tmp_path, _use_new_zipfile_serialization=True)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def snapshot_state(state):
+    """
+    Returns a copy of a (nested) checkpoint with every tensor detached and
+    copied to the cpu, safe to save from another thread.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot_state(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot_state(v) for v in state)
+    return state
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a DataLoader and copies the next batch to the device on a side CUDA
+    stream while the current batch is being processed.
+    """
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+        self.loader_iter = None
+        self.next_batch = None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.loader_iter = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.loader_iter)
+        except StopIteration:
+            self.next_batch = None
+            return
+
+        if self.stream is None:
+            self.next_batch = tuple(x.to(self.device, memory_format=self.memory_format)
+                                    for x in batch)
+            return
+
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            self.next_batch = tuple(x.to(self.device, non_blocking=True, memory_format=self.memory_format)
+                                    for x in batch)
+
+    def __next__(self):
+        if self.next_batch is None:
+            raise StopIteration
+
+        batch = self.next_batch
+        if self.stream is not None:
+            # the compute stream must see the finished copy and the allocator
+            # must not reuse the memory before the compute stream is done
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for x in batch:
+                x.record_stream(torch.cuda.current_stream())
+
+        self.preload()
+        return batch
+
+
+def random_flip_rot90(tensors, prob=0.3, memory_format=torch.contiguous_format):
+    """
+    Applies the same random horizontal flip, vertical flip and 90 degree
+    rotation to every tensor of a batch, on the tensors' device.
+    """
+    if torch.rand(1).item() < prob:
+        tensors = [torch.flip(x, dims=[-1]) for x in tensors]
+    if torch.rand(1).item() < prob:
+        tensors = [torch.flip(x, dims=[-2]) for x in tensors]
+    if torch.rand(1).item() < prob:
+        k = int(torch.randint(1, 4, (1,)).item())
+        tensors = [torch.rot90(x, k, dims=[-2, -1]) for x in tensors]
+
+    return tuple(x.contiguous(memory_format=memory_format) for x in tensors)
 
 
 # test_metrics val_metrics